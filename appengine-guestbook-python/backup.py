@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import json
+import time
+
+from google.appengine.api import app_identity
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import cloudstorage
+import webapp2
+
+from guestbook import AuthorProfile, Greeting, fetch_authors, guestbook_key
+
+BATCH_SIZE = 500
+MAX_FILES = 100  # Queue.add takes at most 100 tasks.
+MAX_SHARDS = 64
+OVERSAMPLING_FACTOR = 32
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+# Every line of a backup is one Greeting as a JSON object. The Guestbook
+# itself is only the ancestor key of its Greetings, so it is stored as
+# the 'guestbook' field of each line. The AuthorProfile is stored inline
+# as the 'author' field.
+
+def greeting_to_record(greeting, author):
+    """Converts a Greeting and its Author into a JSON-serializable dict."""
+    if author:
+        author = {'identity': author.identity, 'email': author.email}
+    return {
+        'guestbook': greeting.key.parent().id(),
+        'id': greeting.key.id(),
+        'author': author,
+        'content': greeting.content,
+        'date': greeting.date.strftime(DATE_FORMAT),
+    }
+
+
+def record_to_greeting(record):
+    """Converts a dict written by greeting_to_record back into entities.
+
+    Returns the Greeting and its AuthorProfile, which is None for an
+    anonymous Greeting.
+    """
+    greeting = Greeting(
+        id=record['id'],
+        parent=guestbook_key(record['guestbook']),
+        content=record['content'],
+        date=datetime.datetime.strptime(record['date'], DATE_FORMAT))
+    profile = None
+    if record['author']:
+        profile = AuthorProfile(
+            id=record['author']['identity'],
+            email=record['author']['email'])
+        greeting.author_key = profile.key
+    return greeting, profile
+
+
+# [START export]
+def iter_pages(query, batch_size=BATCH_SIZE):
+    """Yields the Greetings of the query, one cursor page at a time.
+
+    NDB keeps every entity it fetches in its in-context cache, so the
+    cache is cleared after each page to hold only one page in memory.
+    """
+    cursor = None
+    more = True
+    while more:
+        greetings, cursor, more = query.fetch_page(
+            batch_size, start_cursor=cursor)
+        yield greetings
+        ndb.get_context().clear_cache()
+
+
+def range_query(start_key=None, end_key=None):
+    """Returns a query over the Greeting keys in [start_key, end_key)."""
+    query = Greeting.query()
+    if start_key is not None:
+        query = query.filter(Greeting._key >= start_key)
+    if end_key is not None:
+        query = query.filter(Greeting._key < end_key)
+    return query.order(Greeting._key)
+
+
+def split_key_ranges(shard_count):
+    """Splits the Greeting keys into at most shard_count ranges.
+
+    The split points come from a sample of keys ordered by __scatter__.
+    Returns (start_key, end_key) pairs, where None is an open end.
+    """
+    if shard_count < 2:
+        return [(None, None)]
+    sample_keys = Greeting.query().order(
+        ndb.GenericProperty('__scatter__')).fetch(
+            shard_count * OVERSAMPLING_FACTOR, keys_only=True)
+    sample_keys.sort()
+    step = max(1, len(sample_keys) // shard_count)
+    split_keys = sample_keys[step::step][:shard_count - 1]
+    bounds = [None] + split_keys + [None]
+    return zip(bounds[:-1], bounds[1:])
+
+
+def export_ndjson(out, start_key=None, end_key=None):
+    """Writes the Greetings of a key range to out, one JSON per line."""
+    count = 0
+    for greetings in iter_pages(range_query(start_key, end_key)):
+        for greeting, author in zip(greetings, fetch_authors(greetings)):
+            out.write(json.dumps(greeting_to_record(greeting, author)))
+            out.write('\n')
+            count += 1
+    return count
+
+
+def export_to_gcs(filename, start_key=None, end_key=None):
+    """Streams a key range into the Cloud Storage object filename."""
+    with cloudstorage.open(
+            filename, 'w', content_type='application/x-ndjson') as out:
+        return export_ndjson(out, start_key, end_key)
+# [END export]
+
+
+# [START import]
+def _put_batch(greetings, profiles):
+    """Writes greetings and the profiles that do not exist yet.
+
+    Existing profiles are left alone, so importing an older backup does
+    not roll back the emails of current authors. The batch is dropped
+    from the in-context cache afterwards.
+    """
+    profile_keys = profiles.keys()
+    existing = ndb.get_multi(profile_keys)
+    missing = [profiles[key] for key, profile in zip(profile_keys, existing)
+               if profile is None]
+    ndb.put_multi(greetings + missing)
+    ndb.get_context().clear_cache()
+
+
+def import_ndjson(lines, batch_size=BATCH_SIZE):
+    """Reads NDJSON lines and writes the Greetings with put_multi.
+
+    The AuthorProfiles of each batch are written along with it, unless
+    they already exist.
+    """
+    batch = []
+    profiles = {}
+    max_ids = {}
+    count = 0
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        greeting, profile = record_to_greeting(json.loads(line))
+        if profile:
+            profiles[profile.key] = profile
+        parent = greeting.key.parent()
+        max_ids[parent] = max(max_ids.get(parent, 0), greeting.key.id())
+        batch.append(greeting)
+        if len(batch) >= batch_size:
+            _put_batch(batch, profiles)
+            count += len(batch)
+            batch = []
+            profiles = {}
+    if batch:
+        _put_batch(batch, profiles)
+        count += len(batch)
+
+    # Keep the datastore from allocating the ids that were imported.
+    for parent, max_id in max_ids.iteritems():
+        Greeting.allocate_ids(max=max_id, parent=parent)
+    return count
+
+
+def import_from_gcs(filename):
+    """Imports the NDJSON Cloud Storage object filename."""
+    with cloudstorage.open(filename) as lines:
+        return import_ndjson(lines)
+# [END import]
+
+
+class BackupHandler(webapp2.RequestHandler):
+    """Parses the request parameters of the backup handlers."""
+
+    def shard_count(self):
+        try:
+            shard_count = int(self.request.get('shards', 1))
+        except ValueError:
+            self.abort(400, detail='shards must be an integer')
+        if shard_count < 1:
+            self.abort(400, detail='shards must be at least 1')
+        return min(shard_count, MAX_SHARDS)
+
+    def greeting_key(self, name):
+        urlsafe = self.request.get(name)
+        if not urlsafe:
+            return None
+        # Malformed keys fail in the protocol buffer decoder with
+        # several unrelated exception types.
+        try:
+            key = ndb.Key(urlsafe=urlsafe)
+        except Exception:
+            self.abort(400, detail='{} is not a valid key'.format(name))
+        if key.kind() != 'Greeting':
+            self.abort(400, detail='{} is not a Greeting key'.format(name))
+        return key
+
+    def filenames(self):
+        filenames = self.request.get_all('filename')
+        if not filenames or not all(
+                filename.startswith('/') for filename in filenames):
+            self.abort(400, detail='filename must be /bucket/object')
+        if len(filenames) > MAX_FILES:
+            self.abort(400, detail='at most {} filenames'.format(MAX_FILES))
+        return filenames
+
+    def write_json(self, value):
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps(value))
+
+
+class Export(BackupHandler):
+
+    def post(self):
+        shard_count = self.shard_count()
+        bucket = (self.request.get('bucket') or
+                  app_identity.get_default_gcs_bucket_name())
+        prefix = '/{}/backup/{}'.format(bucket, int(time.time()))
+
+        filenames = []
+        tasks = []
+        for i, (start_key, end_key) in enumerate(
+                split_key_ranges(shard_count)):
+            filename = '{}/{:04d}.ndjson'.format(prefix, i)
+            params = {'filename': filename}
+            if start_key:
+                params['start'] = start_key.urlsafe()
+            if end_key:
+                params['end'] = end_key.urlsafe()
+            filenames.append(filename)
+            tasks.append(taskqueue.Task(
+                url='/backup/tasks/export', params=params))
+        taskqueue.Queue().add(tasks)
+        self.write_json({'files': filenames})
+
+
+class ExportTask(BackupHandler):
+
+    def post(self):
+        count = export_to_gcs(
+            self.filenames()[0],
+            start_key=self.greeting_key('start'),
+            end_key=self.greeting_key('end'))
+        self.write_json({'exported': count})
+
+
+class Import(BackupHandler):
+
+    def post(self):
+        filenames = self.filenames()
+        taskqueue.Queue().add([
+            taskqueue.Task(
+                url='/backup/tasks/import', params={'filename': filename})
+            for filename in filenames])
+        self.write_json({'files': filenames})
+
+
+class ImportTask(BackupHandler):
+
+    def post(self):
+        count = import_from_gcs(self.filenames()[0])
+        self.write_json({'imported': count})
+
+
+# [START app]
+app = webapp2.WSGIApplication([
+    ('/backup/export', Export),
+    ('/backup/import', Import),
+    ('/backup/tasks/export', ExportTask),
+    ('/backup/tasks/import', ImportTask),
+], debug=True)
+# [END app]
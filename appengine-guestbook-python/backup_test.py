@@ -0,0 +1,214 @@
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import json
+import StringIO
+
+from google.appengine.ext import ndb
+import webtest
+
+import backup
+import guestbook
+
+
+def seed():
+    """Stores an anonymous and a signed Greeting in two guestbooks."""
+    profile_key = guestbook.AuthorProfile(
+        id='42', email='author@example.com').put()
+    return ndb.put_multi([
+        guestbook.Greeting(
+            parent=guestbook.guestbook_key('first'), content='anonymous'),
+        guestbook.Greeting(
+            parent=guestbook.guestbook_key('second'), content='signed',
+            author_key=profile_key),
+    ])
+
+
+def run_tasks(testbed, app):
+    """Runs the enqueued backup tasks and returns their responses."""
+    taskqueue_stub = testbed.get_stub('taskqueue')
+    tasks = taskqueue_stub.get_filtered_tasks()
+    taskqueue_stub.FlushQueue('default')
+    return [app.post(task.url, task.payload) for task in tasks]
+
+
+def test_export_import_round_trip(testbed):
+    greeting_keys = seed()
+    greetings = ndb.get_multi(greeting_keys)
+    app = webtest.TestApp(backup.app)
+
+    response = app.post('/backup/export')
+    filenames = json.loads(response.body)['files']
+    responses = run_tasks(testbed, app)
+    assert sum(json.loads(r.body)['exported'] for r in responses) == 2
+
+    ndb.delete_multi(greeting_keys + [ndb.Key(guestbook.AuthorProfile, '42')])
+
+    app.post('/backup/import', {'filename': filenames})
+    responses = run_tasks(testbed, app)
+    assert sum(json.loads(r.body)['imported'] for r in responses) == 2
+
+    anonymous, signed = ndb.get_multi(greeting_keys)
+    assert anonymous.key.parent() == guestbook.guestbook_key('first')
+    assert anonymous.author_key is None
+    assert signed.key.parent() == guestbook.guestbook_key('second')
+    assert signed.author_key.get().email == 'author@example.com'
+    for greeting, imported in zip(greetings, [anonymous, signed]):
+        assert imported.content == greeting.content
+        assert imported.date == greeting.date
+
+
+def test_import_keeps_existing_profiles(testbed):
+    seed()
+    out = StringIO.StringIO()
+    backup.export_ndjson(out)
+    guestbook.AuthorProfile(id='42', email='new@example.com').put()
+
+    assert backup.import_ndjson(out.getvalue().splitlines()) == 2
+    profile = ndb.Key(guestbook.AuthorProfile, '42').get()
+    assert profile.email == 'new@example.com'
+
+
+def test_context_cache_stays_bounded(testbed):
+    seed()
+    ndb.put_multi(
+        [guestbook.Greeting(parent=guestbook.guestbook_key(), content=str(i))
+         for i in range(2 * backup.BATCH_SIZE)])
+    context = ndb.get_context()
+    context.clear_cache()
+
+    out = StringIO.StringIO()
+    backup.export_ndjson(out)
+    assert len(context._cache) < backup.BATCH_SIZE
+
+    backup.import_ndjson(out.getvalue().splitlines())
+    assert len(context._cache) < backup.BATCH_SIZE
+
+
+def test_split_key_ranges(testbed):
+    keys = ndb.put_multi(
+        [guestbook.Greeting(parent=guestbook.guestbook_key(str(i % 5)))
+         for i in range(2000)])
+    ranges = backup.split_key_ranges(4)
+    assert 1 < len(ranges) <= 4
+
+    # The ranges are open at both ends and each starts where the last
+    # one stopped, so together they cover every key exactly once.
+    assert ranges[0][0] is None and ranges[-1][1] is None
+    for (_, end_key), (start_key, _) in zip(ranges, ranges[1:]):
+        assert end_key == start_key
+    range_keys = []
+    for start_key, end_key in ranges:
+        range_keys.extend(
+            backup.range_query(start_key, end_key).fetch(keys_only=True))
+    assert sorted(range_keys) == sorted(keys)
+
+
+def test_bad_parameters(testbed):
+    app = webtest.TestApp(backup.app)
+    app.post('/backup/export?shards=many', status=400)
+    app.post('/backup/export?shards=-1', status=400)
+    app.post('/backup/tasks/export', status=400)
+    for key in ('garbage', guestbook.guestbook_key().urlsafe()):
+        app.post('/backup/tasks/export', {
+            'filename': '/bucket/greetings.ndjson', 'end': key}, status=400)
+    app.post('/backup/import', status=400)
+    app.post('/backup/import', {
+        'filename': ['/bucket/{}'.format(i)
+                     for i in range(backup.MAX_FILES + 1)]}, status=400)
+
+
+# The Cloud Storage client talks to its local stub over urlfetch, and the
+# stub keeps its objects in the datastore. These are the calls it makes to
+# write or read one object, which the task budgets allow on top of their
+# own.
+GCS_WRITE_CALLS = {
+    'app_identity_service.GetAccessToken': 1,
+    'urlfetch.Fetch': 2,
+    'datastore_v3.BeginTransaction': 1,
+    'datastore_v3.Commit': 1,
+    'datastore_v3.Delete': 1,
+    'datastore_v3.Get': 3,
+    'datastore_v3.Put': 5,
+    'datastore_v3.RunQuery': 1,
+    'memcache.Get': 1,
+    'memcache.Set': 1,
+}
+GCS_READ_CALLS = {
+    'app_identity_service.GetAccessToken': 2,
+    'urlfetch.Fetch': 2,
+    'datastore_v3.Get': 3,
+    'memcache.Get': 1,
+    'memcache.Set': 2,
+}
+
+
+def plus(*budgets):
+    total = collections.Counter()
+    for budget in budgets:
+        total.update(budget)
+    return dict(total)
+
+
+def request_task(testbed, rpc_recorder, app):
+    """Serves the one enqueued backup task and records its RPCs."""
+    taskqueue_stub = testbed.get_stub('taskqueue')
+    [task] = taskqueue_stub.get_filtered_tasks()
+    taskqueue_stub.FlushQueue('default')
+    return rpc_recorder.request(app, 'POST', task.url, params=task.payload)
+
+
+def test_rpc_budget(testbed, rpc_recorder):
+    ndb.put_multi(
+        [guestbook.Greeting(parent=guestbook.guestbook_key(), content=str(i))
+         for i in range(2 * backup.BATCH_SIZE)])
+    seed()
+    app = webtest.TestApp(backup.app)
+
+    response = rpc_recorder.request(app, 'POST', '/backup/export')
+    filenames = json.loads(response.body)['files']
+    rpc_recorder.assert_within_budget('POST /backup/export', {
+        'app_identity_service.GetDefaultGcsBucketName': 1,
+        'taskqueue.BulkAdd': 1,
+    }, 1000)
+
+    request_task(testbed, rpc_recorder, app)
+    # One query and one batch get of authors per page of BATCH_SIZE.
+    pages = 3
+    rpc_recorder.assert_within_budget('POST /backup/tasks/export', plus({
+        'datastore_v3.RunQuery': pages,
+        'datastore_v3.Next': pages - 1,
+        'datastore_v3.Get': pages,
+        'memcache.Get': 2 * pages,
+        'memcache.Set': 2 * pages,
+    }, GCS_WRITE_CALLS), 5000)
+
+    rpc_recorder.request(
+        app, 'POST', '/backup/import', params={'filename': filenames})
+    rpc_recorder.assert_within_budget('POST /backup/import', {
+        'taskqueue.BulkAdd': 1,
+    }, 1000)
+
+    request_task(testbed, rpc_recorder, app)
+    # One put_multi per batch, one batch get of the profiles of a batch
+    # that has authors, and one id reservation per guestbook.
+    rpc_recorder.assert_within_budget('POST /backup/tasks/import', plus({
+        'datastore_v3.Put': 3,
+        'datastore_v3.Get': 1,
+        'datastore_v3.AllocateIds': 3,
+        'memcache.Get': 2,
+        'memcache.Set': 5,
+        'memcache.Delete': 3,
+    }, GCS_READ_CALLS), 10000)
@@ -0,0 +1,41 @@
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+
+@pytest.fixture
+def testbed():
+    """Activates the App Engine service stubs for a test."""
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import ndb
+    from google.appengine.ext import testbed
+
+    testbed = testbed.Testbed()
+    testbed.activate()
+    # Queries see every write, as ancestor queries do in production.
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+        probability=1.0)
+    testbed.init_datastore_v3_stub(consistency_policy=policy)
+    testbed.init_memcache_stub()
+    testbed.init_user_stub()
+    testbed.init_app_identity_stub()
+    testbed.init_urlfetch_stub()
+    testbed.init_blobstore_stub()
+    testbed.init_taskqueue_stub()
+    ndb.get_context().clear_cache()
+
+    yield testbed
+
+    testbed.deactivate()
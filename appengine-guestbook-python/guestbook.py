@@ -47,22 +47,83 @@ def guestbook_key(guestbook_name=DEFAULT_GUESTBOOK_NAME):
 
 
 # [START greeting]
+class AuthorProfile(ndb.Model):
+    """A main model for the profile of an author, keyed by user id.
+
+    Greetings refer to the profile instead of copying it, so a changed
+    email is shown on every Greeting the author wrote.
+    """
+    email = ndb.StringProperty(indexed=False)
+
+    @classmethod
+    def put_for_user(cls, user):
+        """Stores the profile of user if it is missing or outdated."""
+        profile = cls.get_by_id(user.user_id())
+        if profile is None or profile.email != user.email():
+            profile = cls(id=user.user_id(), email=user.email())
+            profile.put()
+        return profile.key
+
+
 class Author(ndb.Model):
-    """Sub model for representing an author."""
+    """Sub model for representing an author.
+
+    Only Greetings stored before AuthorProfile existed still embed it.
+    """
     identity = ndb.StringProperty(indexed=False)
     email = ndb.StringProperty(indexed=False)
 
 
 class Greeting(ndb.Model):
     """A main model for representing an individual Guestbook entry."""
+    author_key = ndb.KeyProperty(kind=AuthorProfile, indexed=False)
     author = ndb.StructuredProperty(Author)
     content = ndb.StringProperty(indexed=False)
     date = ndb.DateTimeProperty(auto_now_add=True)
 # [END greeting]
 
 
+def _profile_key(greeting):
+    """Returns the key of the AuthorProfile of greeting, if it has one."""
+    if greeting.author_key:
+        return greeting.author_key
+    if greeting.author and greeting.author.identity:
+        return ndb.Key(AuthorProfile, greeting.author.identity)
+    return None
+
+
+def fetch_authors(greetings):
+    """Returns the Author of each greeting, or None if it is anonymous.
+
+    The profiles of all greetings are read with a single batch get,
+    which NDB serves from memcache when it can. A Greeting that still
+    embeds its Author uses that copy only if the author has no profile.
+    """
+    profile_keys = list(set(
+        key for key in map(_profile_key, greetings) if key))
+    profiles = dict(zip(profile_keys, ndb.get_multi(profile_keys)))
+
+    authors = []
+    for greeting in greetings:
+        profile = profiles.get(_profile_key(greeting))
+        if profile:
+            authors.append(
+                Author(identity=profile.key.id(), email=profile.email))
+        else:
+            authors.append(greeting.author)
+    return authors
+
+
+class BaseHandler(webapp2.RequestHandler):
+
+    @webapp2.cached_property
+    def user(self):
+        """The current user, looked up once per request."""
+        return users.get_current_user()
+
+
 # [START main_page]
-class MainPage(webapp2.RequestHandler):
+class MainPage(BaseHandler):
 
     def get(self):
         guestbook_name = self.request.get('guestbook_name',
@@ -70,8 +131,9 @@ class MainPage(webapp2.RequestHandler):
         greetings_query = Greeting.query(
             ancestor=guestbook_key(guestbook_name)).order(-Greeting.date)
         greetings = greetings_query.fetch(10)
+        authors = fetch_authors(greetings)
 
-        user = users.get_current_user()
+        user = self.user
         if user:
             url = users.create_logout_url(self.request.uri)
             url_linktext = 'Logout'
@@ -80,8 +142,8 @@ class MainPage(webapp2.RequestHandler):
             url_linktext = 'Login'
 
         template_values = {
-            'user': user,
-            'greetings': greetings,
+            'user_id': user.user_id() if user else None,
+            'greetings': zip(greetings, authors),
             'guestbook_name': urllib.quote_plus(guestbook_name),
             'url': url,
             'url_linktext': url_linktext,
@@ -93,7 +155,7 @@ class MainPage(webapp2.RequestHandler):
 
 
 # [START guestbook]
-class Guestbook(webapp2.RequestHandler):
+class Guestbook(BaseHandler):
 
     def post(self):
         # We set the same parent key on the 'Greeting' to ensure each
@@ -105,10 +167,8 @@ class Guestbook(webapp2.RequestHandler):
                                           DEFAULT_GUESTBOOK_NAME)
         greeting = Greeting(parent=guestbook_key(guestbook_name))
 
-        if users.get_current_user():
-            greeting.author = Author(
-                    identity=users.get_current_user().user_id(),
-                    email=users.get_current_user().email())
+        if self.user:
+            greeting.author_key = AuthorProfile.put_for_user(self.user)
 
         greeting.content = self.request.get('content')
         greeting.put()
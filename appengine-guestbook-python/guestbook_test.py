@@ -0,0 +1,166 @@
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from google.appengine.ext import ndb
+import pytest
+import webtest
+
+import guestbook
+
+AUTHOR_COUNT = 10
+GREETINGS_PER_AUTHOR = 3
+
+
+def login(testbed, user_id='0', email='author0@example.com'):
+    testbed.setup_env(
+        user_id=user_id, user_email=email, user_is_admin='0', overwrite=True)
+
+
+def seed():
+    """Stores GREETINGS_PER_AUTHOR greetings by each of AUTHOR_COUNT authors."""
+    profile_keys = ndb.put_multi(
+        [guestbook.AuthorProfile(
+            id=str(i), email='author{}@example.com'.format(i))
+         for i in range(AUTHOR_COUNT)])
+    ndb.put_multi(
+        [guestbook.Greeting(
+            parent=guestbook.guestbook_key(), author_key=profile_key,
+            content='greeting{}'.format(i))
+         for profile_key in profile_keys
+         for i in range(GREETINGS_PER_AUTHOR)])
+
+
+def count_greetings():
+    return guestbook.Greeting.query(
+        ancestor=guestbook.guestbook_key()).count()
+
+
+# Budgets are per request with cold caches, against the data from seed(),
+# as a signed-in author whose profile is up to date. The main page reads
+# the profiles of all of its authors with one batch get.
+ROUTES = [
+    ('GET', '/', {}, 200, AUTHOR_COUNT * GREETINGS_PER_AUTHOR, {
+        'datastore_v3.RunQuery': 1,
+        'datastore_v3.Get': 1,
+        'memcache.Get': 2,
+        'memcache.Set': 2,
+        'user.CreateLogoutURL': 1,
+    }, 2000),
+    ('POST', '/sign', {'content': 'hello'},
+     302, AUTHOR_COUNT * GREETINGS_PER_AUTHOR + 1, {
+        'datastore_v3.Get': 1,
+        'datastore_v3.Put': 1,
+        'memcache.Get': 2,
+        'memcache.Set': 2,
+        'memcache.Delete': 1,
+    }, 1000),
+]
+
+
+def request(testbed, rpc_recorder, method, url, params, status):
+    """Seeds the datastore and serves one recorded request."""
+    seed()
+    login(testbed)
+    app = webtest.TestApp(guestbook.app)
+
+    response = rpc_recorder.request(app, method, url, params=params)
+    assert response.status_int == status
+    return '{} {}'.format(method, url)
+
+
+@pytest.mark.parametrize(
+    'method, url, params, status, greeting_count, calls, latency_ms', ROUTES)
+def test_rpc_budget(testbed, rpc_recorder, method, url, params, status,
+                    greeting_count, calls, latency_ms):
+    label = request(testbed, rpc_recorder, method, url, params, status)
+    assert count_greetings() == greeting_count
+    rpc_recorder.assert_within_budget(label, calls, latency_ms)
+
+
+@pytest.mark.parametrize(
+    'method, url, params, status, greeting_count, calls, latency_ms', ROUTES)
+def test_rpc_calls_do_not_grow(testbed, rpc_recorder, method, url, params,
+                               status, greeting_count, calls, latency_ms):
+    request(testbed, rpc_recorder, method, url, params, status)
+    calls = rpc_recorder.calls.copy()
+    # seed() again doubles the greetings of every author.
+    label = request(testbed, rpc_recorder, method, url, params, status)
+    rpc_recorder.assert_no_growth(label, calls)
+
+
+def test_put_for_user_writes_only_when_needed(testbed, rpc_recorder):
+    login(testbed, '7', 'old@example.com')
+    app = webtest.TestApp(guestbook.app)
+    app.post('/sign', {'content': 'first'})
+    assert ndb.Key(guestbook.AuthorProfile, '7').get().email == (
+        'old@example.com')
+
+    rpc_recorder.request(app, 'POST', '/sign', params={'content': 'again'})
+    assert rpc_recorder.calls['datastore_v3.Put'] == 1
+
+    login(testbed, '7', 'new@example.com')
+    rpc_recorder.request(app, 'POST', '/sign', params={'content': 'moved'})
+    assert rpc_recorder.calls['datastore_v3.Put'] == 2
+    assert ndb.Key(guestbook.AuthorProfile, '7').get().email == (
+        'new@example.com')
+
+
+def test_fetch_authors(testbed, rpc_recorder):
+    seed()
+    legacy = guestbook.Greeting(
+        parent=guestbook.guestbook_key(), content='legacy',
+        author=guestbook.Author(identity='3', email='stale@example.com'))
+    orphan = guestbook.Greeting(
+        parent=guestbook.guestbook_key(), content='orphan',
+        author=guestbook.Author(identity='99', email='orphan@example.com'))
+    anonymous = guestbook.Greeting(
+        parent=guestbook.guestbook_key(), content='anonymous')
+    ndb.put_multi([legacy, orphan, anonymous])
+    greetings = guestbook.Greeting.query(
+        ancestor=guestbook.guestbook_key()).fetch()
+
+    with rpc_recorder.recording():
+        authors = guestbook.fetch_authors(greetings)
+    # Eleven profiles span two Get RPCs of at most 10 entity groups.
+    assert rpc_recorder.calls['datastore_v3.Get'] == 2
+
+    by_content = dict(
+        (greeting.content, author)
+        for greeting, author in zip(greetings, authors))
+    assert by_content['greeting0'].email.endswith('@example.com')
+    assert by_content['legacy'].email == 'author3@example.com'
+    assert by_content['orphan'].email == 'orphan@example.com'
+    assert by_content['anonymous'] is None
+
+
+def test_main_page_renders_authors(testbed):
+    guestbook.AuthorProfile(id='3', email='current@example.com').put()
+    ndb.put_multi([
+        guestbook.Greeting(
+            parent=guestbook.guestbook_key(), content='legacy',
+            author=guestbook.Author(identity='3', email='stale@example.com')),
+        guestbook.Greeting(
+            parent=guestbook.guestbook_key(), content='mine',
+            author_key=ndb.Key(guestbook.AuthorProfile, '7')),
+        guestbook.Greeting(
+            parent=guestbook.guestbook_key(), content='anonymous'),
+    ])
+    guestbook.AuthorProfile(id='7', email='me@example.com').put()
+    login(testbed, '7', 'me@example.com')
+
+    body = webtest.TestApp(guestbook.app).get('/').body
+    assert 'current@example.com' in body
+    assert 'stale@example.com' not in body
+    assert body.count('(You)') == 1
+    assert 'An anonymous person wrote' in body
@@ -0,0 +1,113 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""RPC budget harness for the App Engine handler tests.
+
+The rpc_recorder fixture counts every API call made while a request is
+served, keyed by 'service.Method' (for example 'datastore_v3.RunQuery'),
+and times the request. assert_within_budget compares the counts and the
+latency with a declared budget and fails with a report of what grew.
+assert_no_growth compares the counts with those of the same request
+against less data, which catches calls made once per entity.
+
+Latency budgets are calibrated generously against the local service
+stubs. Set RPC_BUDGET_LATENCY_FACTOR to scale them on slower machines,
+for example RPC_BUDGET_LATENCY_FACTOR=5 when running under coverage.
+"""
+
+import collections
+import contextlib
+import os
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+import pytest
+
+LATENCY_FACTOR = float(os.environ.get('RPC_BUDGET_LATENCY_FACTOR', 1))
+
+
+class RpcRecorder(object):
+    """Counts the API calls made while recording."""
+
+    def __init__(self):
+        self.calls = collections.Counter()
+        self.latency_ms = 0.0
+        self.active = False
+
+    def record(self, service, call, request, response):
+        if self.active:
+            self.calls['{}.{}'.format(service, call)] += 1
+
+    @contextlib.contextmanager
+    def recording(self):
+        """Records the RPCs of the enclosed code, starting cold."""
+        ndb.get_context().clear_cache()
+        memcache.flush_all()
+        self.calls.clear()
+        self.active = True
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.latency_ms = (time.time() - start) * 1000
+            self.active = False
+
+    def request(self, app, method, url, **kwargs):
+        """Serves one request with cold caches and records its RPCs."""
+        with self.recording():
+            return getattr(app, method.lower())(url, **kwargs)
+
+    def _over(self, calls):
+        over = []
+        for name in sorted(set(self.calls) | set(calls)):
+            used, allowed = self.calls[name], calls.get(name, 0)
+            if used > allowed:
+                over.append('  {:<44} {:>4} > {:>4}'.format(
+                    name, used, allowed))
+        return over
+
+    def assert_within_budget(self, label, calls, latency_ms):
+        """Fails if any call count or the latency exceeds the budget.
+
+        Calls that are missing from the budget are allowed zero times.
+        """
+        over = self._over(calls)
+        latency_ms *= LATENCY_FACTOR
+        if self.latency_ms > latency_ms:
+            over.append('  {:<44} {:>4.0f} > {:>4.0f} ms'.format(
+                'latency', self.latency_ms, latency_ms))
+        if over:
+            pytest.fail('{} is over its RPC budget:\n{}'.format(
+                label, '\n'.join(over)))
+
+    def assert_no_growth(self, label, calls):
+        """Fails if any call count grew past the earlier counts in calls.
+
+        Record the same request before and after adding more data and
+        pass the first counts here.
+        """
+        over = self._over(calls)
+        if over:
+            pytest.fail('{} makes more calls with more data:\n{}'.format(
+                label, '\n'.join(over)))
+
+
+@pytest.fixture
+def rpc_recorder(testbed):
+    recorder = RpcRecorder()
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'rpc_recorder', recorder.record)
+    return recorder
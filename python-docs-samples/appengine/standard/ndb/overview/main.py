@@ -24,10 +24,13 @@ For more information, see README.md
 import cgi
 import urllib
 
+from google.appengine.api import datastore_errors
 from google.appengine.ext import ndb
 
 import webapp2
 
+BOOKS_PER_PAGE = 20
+
 
 class Book(ndb.Model):
     name = ndb.StringProperty()
@@ -45,6 +48,17 @@ class Book(ndb.Model):
     def fetch_books(cls):
         return cls.query().order(cls.name)
 
+    @classmethod
+    def fetch_greeting_nums(cls, books):
+        """Returns the greeting count of each book by key.
+
+        The count queries of all books run in parallel.
+        """
+        futures = [Greeting.query(ancestor=book.key).count_async()
+                   for book in books]
+        return dict((book.key, future.get_result())
+                    for book, future in zip(books, futures))
+
 
 # [START greeting]
 class Greeting(ndb.Model):
@@ -61,15 +75,26 @@ class MainPage(webapp2.RequestHandler):
         write('<ul>')
         write('<h2>Guestbook List</h2>')
 
-        for book in Book.fetch_books():
+        try:
+            cursor = ndb.Cursor(urlsafe=self.request.get('cursor'))
+        except datastore_errors.BadValueError:
+            self.abort(400, detail='cursor is not valid')
+        books, cursor, more = Book.fetch_books().fetch_page(
+            BOOKS_PER_PAGE, start_cursor=cursor)
+        greeting_nums = Book.fetch_greeting_nums(books)
+
+        for book in books:
             book_item = '<li><a href="/books/{id}">{name} : {greeting_num}</a></li>'.format(
                 id = book.key.id(),
                 name = book.name,
-                greeting_num = book.fetch_greeting_num()
+                greeting_num = greeting_nums[book.key]
             )
             write(book_item)
 
         write('</ul>')
+        if more:
+            write('<a href="/?%s">Next</a>' % urllib.urlencode(
+                {'cursor': cursor.urlsafe()}))
         write("""
             <hr>
             <form action="/?%s" method="post">
@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from google.appengine.ext import ndb
+import pytest
 import webtest
 
 import main
@@ -21,3 +23,106 @@ def test_app(testbed):
     app = webtest.TestApp(main.app)
     response = app.get('/')
     assert response.status_int == 200
+
+
+# More books than fit on one page of the book list.
+BOOK_COUNT = 30
+GREETINGS_PER_BOOK = 25
+
+
+def seed():
+    """Stores BOOK_COUNT books with greetings."""
+    book_keys = ndb.put_multi(
+        [main.Book(name='book{}'.format(i)) for i in range(BOOK_COUNT)])
+    ndb.put_multi(
+        [main.Greeting(parent=book_key, content='greeting{}'.format(i))
+         for book_key in book_keys for i in range(GREETINGS_PER_BOOK)])
+    return book_keys
+
+
+def check_nothing(book_key):
+    pass
+
+
+def check_book_added(book_key):
+    assert main.Book.query().count() == BOOK_COUNT + 1
+
+
+def check_greeting_added(book_key):
+    assert book_key.get().fetch_greeting_num() == GREETINGS_PER_BOOK + 1
+
+
+# Budgets are per request with cold caches, against the data from seed().
+# The book list shows one page of books and counts the greetings of each
+# of them, so its query budget grows with BOOKS_PER_PAGE; any further
+# per-book call fails.
+ROUTES = [
+    ('GET', '/', {}, 200, check_nothing, {
+        'datastore_v3.RunQuery': 1 + main.BOOKS_PER_PAGE,
+        'datastore_v3.Next': 1,
+    }, 2000),
+    ('POST', '/', {'guestbook_name': 'new'}, 302, check_book_added, {
+        'datastore_v3.Put': 1,
+        'memcache.Delete': 1,
+    }, 1000),
+    ('GET', '/books/{book_id}', {}, 200, check_nothing, {
+        'datastore_v3.RunQuery': 1,
+        'datastore_v3.Get': 1,
+        'memcache.Get': 2,
+        'memcache.Set': 2,
+    }, 1000),
+    ('POST', '/sign', {'guestbook_id': '{book_id}', 'content': 'hello'},
+     302, check_greeting_added, {
+        'datastore_v3.Get': 1,
+        'datastore_v3.Put': 1,
+        'memcache.Get': 2,
+        'memcache.Set': 2,
+        'memcache.Delete': 1,
+    }, 1000),
+]
+
+
+def request(rpc_recorder, method, url, params, status):
+    """Seeds the datastore and serves one recorded request."""
+    book_key = seed()[0]
+    book_id = book_key.id()
+    url = url.format(book_id=book_id)
+    params = dict((name, value.format(book_id=book_id))
+                  for name, value in params.items())
+    app = webtest.TestApp(main.app)
+
+    response = rpc_recorder.request(app, method, url, params=params)
+    assert response.status_int == status
+    return book_key, '{} {}'.format(method, url)
+
+
+@pytest.mark.parametrize(
+    'method, url, params, status, check, calls, latency_ms', ROUTES)
+def test_rpc_budget(rpc_recorder, method, url, params, status, check, calls,
+                    latency_ms):
+    book_key, label = request(rpc_recorder, method, url, params, status)
+    check(book_key)
+    rpc_recorder.assert_within_budget(label, calls, latency_ms)
+
+
+@pytest.mark.parametrize(
+    'method, url, params, status, check, calls, latency_ms', ROUTES)
+def test_rpc_calls_do_not_grow(rpc_recorder, method, url, params, status,
+                               check, calls, latency_ms):
+    request(rpc_recorder, method, url, params, status)
+    calls = rpc_recorder.calls.copy()
+    # seed() again doubles the books and greetings.
+    _, label = request(rpc_recorder, method, url, params, status)
+    rpc_recorder.assert_no_growth(label, calls)
+
+
+def test_book_list_pages(testbed):
+    seed()
+    app = webtest.TestApp(main.app)
+
+    response = app.get('/')
+    assert response.body.count('<li>') == main.BOOKS_PER_PAGE
+    response = response.click('Next')
+    assert response.body.count('<li>') == BOOK_COUNT - main.BOOKS_PER_PAGE
+    assert 'Next' not in response.body
+    app.get('/?cursor=garbage', status=400)
@@ -0,0 +1,314 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""NDJSON export and import of Books, Greetings and Tags.
+
+Every line of a backup file is one JSON object describing one entity.
+POST /api/backup/export/<kind> splits the kind into key ranges and
+enqueues one task per range. Each task walks its range with query
+cursors and streams the entities to its own Cloud Storage object, so
+only one batch of entities is held in memory at a time. The tasks clear
+the NDB in-context cache after every batch for the same reason.
+
+POST /api/backup/import enqueues one task per Cloud Storage object. The
+tasks batch-write the entities with put_multi and keep their original
+ids, so Greeting ancestors and Book tag keys stay intact.
+"""
+
+import datetime
+import json
+import time
+
+from google.appengine.api import app_identity
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import cloudstorage
+import webapp2
+
+from main import Book, Greeting, Tag
+
+BATCH_SIZE = 500
+MAX_FILES = 100  # Queue.add takes at most 100 tasks.
+MAX_SHARDS = 64
+OVERSAMPLING_FACTOR = 32
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+MODELS = dict((model._get_kind(), model) for model in (Tag, Book, Greeting))
+
+
+def _format_date(date):
+    return date.strftime(DATE_FORMAT) if date else None
+
+
+def _parse_date(value):
+    return datetime.datetime.strptime(value, DATE_FORMAT) if value else None
+
+
+def entity_to_record(entity):
+    """Converts an entity into a JSON-serializable dict."""
+    kind = entity.key.kind()
+    record = {'kind': kind, 'id': entity.key.id()}
+    if kind == 'Tag':
+        record['name'] = entity.name
+    elif kind == 'Book':
+        record['name'] = entity.name
+        record['tags'] = [tag_key.id() for tag_key in entity.tags]
+    elif kind == 'Greeting':
+        record['book_id'] = entity.key.parent().id()
+        record['content'] = entity.content
+        record['date'] = _format_date(entity.date)
+    return record
+
+
+def record_to_entity(record):
+    """Converts a dict written by entity_to_record back into an entity."""
+    kind = record['kind']
+    if kind == 'Tag':
+        return Tag(id=record['id'], name=record['name'])
+    elif kind == 'Book':
+        return Book(
+            id=record['id'],
+            name=record['name'],
+            tags=[ndb.Key(Tag, tag_id) for tag_id in record['tags']])
+    elif kind == 'Greeting':
+        return Greeting(
+            id=record['id'],
+            parent=ndb.Key(Book, record['book_id']),
+            content=record['content'],
+            date=_parse_date(record['date']))
+    raise ValueError('Unknown kind: {}'.format(kind))
+
+
+def iter_entities(query, batch_size=BATCH_SIZE):
+    """Yields every entity of the query, one cursor page at a time.
+
+    NDB keeps every fetched entity in its in-context cache, so the cache
+    is cleared after each page to hold only one page in memory.
+    """
+    cursor = None
+    more = True
+    while more:
+        entities, cursor, more = query.fetch_page(
+            batch_size, start_cursor=cursor)
+        for entity in entities:
+            yield entity
+        ndb.get_context().clear_cache()
+
+
+def range_query(model, start_key=None, end_key=None):
+    """Returns a query over the keys in [start_key, end_key)."""
+    query = model.query()
+    if start_key is not None:
+        query = query.filter(model._key >= start_key)
+    if end_key is not None:
+        query = query.filter(model._key < end_key)
+    return query.order(model._key)
+
+
+def split_key_ranges(model, shard_count):
+    """Splits the keys of a kind into at most shard_count ranges.
+
+    Split points are picked from a sample of keys ordered by the
+    __scatter__ property, which the datastore sets on a random subset of
+    entities. Returns a list of (start_key, end_key) pairs, where None
+    stands for an open end.
+    """
+    if shard_count < 2:
+        return [(None, None)]
+    sample_keys = model.query().order(
+        ndb.GenericProperty('__scatter__')).fetch(
+            shard_count * OVERSAMPLING_FACTOR, keys_only=True)
+    sample_keys.sort()
+    step = max(1, len(sample_keys) // shard_count)
+    split_keys = sample_keys[step::step][:shard_count - 1]
+    bounds = [None] + split_keys + [None]
+    return zip(bounds[:-1], bounds[1:])
+
+
+def export_ndjson(out, model, start_key=None, end_key=None):
+    """Writes every entity of a key range to out, one JSON per line."""
+    count = 0
+    for entity in iter_entities(range_query(model, start_key, end_key)):
+        out.write(json.dumps(entity_to_record(entity)))
+        out.write('\n')
+        count += 1
+    return count
+
+
+def _reserve_ids(max_ids):
+    """Keeps the datastore from allocating ids that were imported."""
+    for (kind, parent), max_id in max_ids.iteritems():
+        MODELS[kind].allocate_ids(max=max_id, parent=parent)
+
+
+def _put_batch(entities):
+    """Writes a batch and drops it from the in-context cache."""
+    ndb.put_multi(entities)
+    ndb.get_context().clear_cache()
+
+
+def import_ndjson(lines, batch_size=BATCH_SIZE):
+    """Reads NDJSON lines and writes the entities with put_multi."""
+    batch = []
+    max_ids = {}
+    count = 0
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        entity = record_to_entity(json.loads(line))
+        key = entity.key
+        if isinstance(key.id(), (int, long)):
+            group = (key.kind(), key.parent())
+            max_ids[group] = max(max_ids.get(group, 0), key.id())
+        batch.append(entity)
+        if len(batch) >= batch_size:
+            _put_batch(batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        _put_batch(batch)
+        count += len(batch)
+    _reserve_ids(max_ids)
+    return count
+
+
+def export_to_gcs(filename, model, start_key=None, end_key=None):
+    """Streams a key range into the Cloud Storage object filename."""
+    with cloudstorage.open(
+            filename, 'w', content_type='application/x-ndjson') as out:
+        return export_ndjson(out, model, start_key, end_key)
+
+
+def import_from_gcs(filename):
+    """Imports the NDJSON Cloud Storage object filename."""
+    with cloudstorage.open(filename) as lines:
+        return import_ndjson(lines)
+
+
+def _fetch_or_raise_model(kind):
+    model = MODELS.get(kind)
+    if model is None:
+        raise RuntimeError('No such kind: {}'.format(kind))
+    return model
+
+
+class BackupHandler:
+    """Parses the request parameters of the backup handlers."""
+
+    def fetch_model(self, kind):
+        try:
+            return _fetch_or_raise_model(kind)
+        except RuntimeError, e:
+            self.abort(404, detail=str(e))
+
+    def shard_count(self):
+        try:
+            shard_count = int(self.request.get('shards', 1))
+        except ValueError:
+            self.abort(400, detail='shards must be an integer')
+        if shard_count < 1:
+            self.abort(400, detail='shards must be at least 1')
+        return min(shard_count, MAX_SHARDS)
+
+    def key(self, name, model):
+        urlsafe = self.request.get(name)
+        if not urlsafe:
+            return None
+        # Malformed keys fail in the protocol buffer decoder with
+        # several unrelated exception types.
+        try:
+            key = ndb.Key(urlsafe=urlsafe)
+        except Exception:
+            self.abort(400, detail='{} is not a valid key'.format(name))
+        if key.kind() != model._get_kind():
+            self.abort(400, detail='{} is not a {} key'.format(
+                name, model._get_kind()))
+        return key
+
+    def filenames(self):
+        filenames = self.request.get_all('filename')
+        if not filenames or not all(
+                filename.startswith('/') for filename in filenames):
+            self.abort(400, detail='filename must be /bucket/object')
+        if len(filenames) > MAX_FILES:
+            self.abort(400, detail='at most {} filenames'.format(MAX_FILES))
+        return filenames
+
+    def write_json(self, value):
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps(value))
+
+
+class ExportHandler(BackupHandler, webapp2.RequestHandler):
+    def post(self, kind):
+        model = self.fetch_model(kind)
+        shard_count = self.shard_count()
+        bucket = (self.request.get('bucket') or
+                  app_identity.get_default_gcs_bucket_name())
+        prefix = '/{}/backup/{}/{}'.format(bucket, kind, int(time.time()))
+
+        filenames = []
+        tasks = []
+        ranges = split_key_ranges(model, shard_count)
+        for i, (start_key, end_key) in enumerate(ranges):
+            filename = '{}/{:04d}.ndjson'.format(prefix, i)
+            params = {'filename': filename}
+            if start_key:
+                params['start'] = start_key.urlsafe()
+            if end_key:
+                params['end'] = end_key.urlsafe()
+            filenames.append(filename)
+            tasks.append(taskqueue.Task(
+                url='/api/backup/tasks/export/{}'.format(kind),
+                params=params))
+        taskqueue.Queue().add(tasks)
+        self.write_json({'files': filenames})
+
+
+class ExportTaskHandler(BackupHandler, webapp2.RequestHandler):
+    def post(self, kind):
+        model = self.fetch_model(kind)
+        filename = self.filenames()[0]
+        count = export_to_gcs(
+            filename, model,
+            start_key=self.key('start', model),
+            end_key=self.key('end', model))
+        self.write_json({'exported': count})
+
+
+class ImportHandler(BackupHandler, webapp2.RequestHandler):
+    def post(self):
+        filenames = self.filenames()
+        taskqueue.Queue().add([
+            taskqueue.Task(
+                url='/api/backup/tasks/import',
+                params={'filename': filename})
+            for filename in filenames])
+        self.write_json({'files': filenames})
+
+
+class ImportTaskHandler(BackupHandler, webapp2.RequestHandler):
+    def post(self):
+        count = import_from_gcs(self.filenames()[0])
+        self.write_json({'imported': count})
+
+
+app = webapp2.WSGIApplication([
+    ('/api/backup/export/(\w+)', ExportHandler),
+    ('/api/backup/import', ImportHandler),
+    ('/api/backup/tasks/export/(\w+)', ExportTaskHandler),
+    ('/api/backup/tasks/import', ImportTaskHandler)
+])
@@ -0,0 +1,234 @@
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import json
+import StringIO
+
+from google.appengine.ext import ndb
+import cloudstorage
+import webtest
+
+import backup
+import main
+
+
+def seed():
+    tag_key = main.Tag(name='python').put()
+    book = main.Book(name='book', tags=[tag_key])
+    book_key = book.put()
+    for i in range(3):
+        book.put_greeting('greeting {}'.format(i))
+    return book_key, tag_key
+
+
+def run_tasks(testbed, app):
+    """Runs the enqueued backup tasks and returns their responses."""
+    taskqueue_stub = testbed.get_stub('taskqueue')
+    tasks = taskqueue_stub.get_filtered_tasks()
+    taskqueue_stub.FlushQueue('default')
+    return [app.post(task.url, task.payload) for task in tasks]
+
+
+def test_export_import_round_trip(testbed):
+    book_key, tag_key = seed()
+    app = webtest.TestApp(backup.app)
+
+    filenames = []
+    for kind in ('Tag', 'Book', 'Greeting'):
+        response = app.post('/api/backup/export/{}'.format(kind))
+        filenames.extend(json.loads(response.body)['files'])
+    responses = run_tasks(testbed, app)
+    assert sum(json.loads(r.body)['exported'] for r in responses) == 5
+
+    ndb.delete_multi(
+        [book_key, tag_key] +
+        main.Greeting.query(ancestor=book_key).fetch(keys_only=True))
+
+    app.post('/api/backup/import', {'filename': filenames})
+    responses = run_tasks(testbed, app)
+    assert sum(json.loads(r.body)['imported'] for r in responses) == 5
+
+    book = book_key.get()
+    assert book.name == 'book'
+    assert book.tags == [tag_key]
+    assert tag_key.get().name == 'python'
+    assert book.fetch_greeting_num() == 3
+
+
+def test_export_key_range(testbed):
+    keys = [main.Tag(id=i, name=str(i)).put() for i in range(1, 7)]
+    filename = '/bucket/tags.ndjson'
+    count = backup.export_to_gcs(
+        filename, main.Tag, start_key=keys[2], end_key=keys[4])
+    assert count == 2
+    with cloudstorage.open(filename) as lines:
+        records = [json.loads(line) for line in lines]
+    assert [record['id'] for record in records] == [3, 4]
+
+
+def test_context_cache_stays_bounded(testbed):
+    book_key, _ = seed()
+    ndb.put_multi(
+        [main.Greeting(parent=book_key, content=str(i))
+         for i in range(2 * backup.BATCH_SIZE)])
+    context = ndb.get_context()
+    context.clear_cache()
+
+    out = StringIO.StringIO()
+    backup.export_ndjson(out, main.Greeting)
+    assert len(context._cache) < backup.BATCH_SIZE
+
+    backup.import_ndjson(out.getvalue().splitlines())
+    assert len(context._cache) < backup.BATCH_SIZE
+
+
+def test_split_key_ranges(testbed):
+    keys = ndb.put_multi(
+        [main.Tag(name=str(i)) for i in range(2000)])
+    ranges = backup.split_key_ranges(main.Tag, 4)
+    assert 1 < len(ranges) <= 4
+
+    # The ranges are open at both ends and each starts where the last
+    # one stopped, so together they cover every key exactly once.
+    assert ranges[0][0] is None and ranges[-1][1] is None
+    for (_, end_key), (start_key, _) in zip(ranges, ranges[1:]):
+        assert end_key == start_key
+    range_keys = []
+    for start_key, end_key in ranges:
+        range_keys.extend(backup.range_query(
+            main.Tag, start_key, end_key).fetch(keys_only=True))
+    assert sorted(range_keys) == sorted(keys)
+
+
+def test_export_enqueues_a_task_per_range(testbed):
+    ndb.put_multi([main.Tag(name=str(i)) for i in range(2000)])
+    app = webtest.TestApp(backup.app)
+
+    response = app.post('/api/backup/export/Tag?shards=4')
+    filenames = json.loads(response.body)['files']
+    assert 1 < len(filenames) <= 4
+    responses = run_tasks(testbed, app)
+    assert len(responses) == len(filenames)
+    assert sum(json.loads(r.body)['exported'] for r in responses) == 2000
+
+
+def test_export_unknown_kind(testbed):
+    app = webtest.TestApp(backup.app)
+    app.post('/api/backup/export/Unknown', status=404)
+
+
+def test_bad_parameters(testbed):
+    book_key, tag_key = seed()
+    app = webtest.TestApp(backup.app)
+    app.post('/api/backup/export/Tag?shards=many', status=400)
+    app.post('/api/backup/export/Tag?shards=0', status=400)
+    app.post('/api/backup/tasks/export/Tag', status=400)
+    for key in ('garbage', '!!!', book_key.urlsafe()):
+        app.post('/api/backup/tasks/export/Tag', {
+            'filename': '/bucket/tags.ndjson', 'start': key}, status=400)
+    app.post('/api/backup/import', {'filename': 'bucket'}, status=400)
+    app.post('/api/backup/import', {
+        'filename': ['/bucket/{}'.format(i)
+                     for i in range(backup.MAX_FILES + 1)]}, status=400)
+
+
+def test_shards_are_capped(testbed):
+    ndb.put_multi([main.Tag(name=str(i)) for i in range(2000)])
+    app = webtest.TestApp(backup.app)
+    response = app.post('/api/backup/export/Tag?shards=100000')
+    assert len(json.loads(response.body)['files']) <= backup.MAX_SHARDS
+
+
+# The Cloud Storage client talks to its local stub over urlfetch, and the
+# stub keeps its objects in the datastore. These are the calls it makes to
+# write or read one object, which the task budgets allow on top of their
+# own.
+GCS_WRITE_CALLS = {
+    'app_identity_service.GetAccessToken': 1,
+    'urlfetch.Fetch': 2,
+    'datastore_v3.BeginTransaction': 1,
+    'datastore_v3.Commit': 1,
+    'datastore_v3.Delete': 1,
+    'datastore_v3.Get': 3,
+    'datastore_v3.Put': 5,
+    'datastore_v3.RunQuery': 1,
+    'memcache.Get': 1,
+    'memcache.Set': 1,
+}
+GCS_READ_CALLS = {
+    'app_identity_service.GetAccessToken': 2,
+    'urlfetch.Fetch': 2,
+    'datastore_v3.Get': 3,
+    'memcache.Get': 1,
+    'memcache.Set': 2,
+}
+
+
+def plus(*budgets):
+    total = collections.Counter()
+    for budget in budgets:
+        total.update(budget)
+    return dict(total)
+
+
+def request_task(testbed, rpc_recorder, app):
+    """Serves the one enqueued backup task and records its RPCs."""
+    taskqueue_stub = testbed.get_stub('taskqueue')
+    [task] = taskqueue_stub.get_filtered_tasks()
+    taskqueue_stub.FlushQueue('default')
+    return rpc_recorder.request(app, 'POST', task.url, params=task.payload)
+
+
+def test_rpc_budget(testbed, rpc_recorder):
+    book_key, _ = seed()
+    app = webtest.TestApp(backup.app)
+    ndb.put_multi(
+        [main.Greeting(parent=book_key, content=str(i))
+         for i in range(2 * backup.BATCH_SIZE)])
+
+    response = rpc_recorder.request(
+        app, 'POST', '/api/backup/export/Greeting')
+    filenames = json.loads(response.body)['files']
+    rpc_recorder.assert_within_budget('POST /api/backup/export/Greeting', {
+        'app_identity_service.GetDefaultGcsBucketName': 1,
+        'taskqueue.BulkAdd': 1,
+    }, 1000)
+
+    request_task(testbed, rpc_recorder, app)
+    # One query per page of BATCH_SIZE greetings, however many there are.
+    # Clearing the in-context cache after a page also drops the upload
+    # state of the stub, which it reads back once from memcache.
+    rpc_recorder.assert_within_budget(
+        'POST /api/backup/tasks/export/Greeting', plus({
+            'datastore_v3.RunQuery': 3,
+            'datastore_v3.Next': 2,
+            'memcache.Get': 1,
+        }, GCS_WRITE_CALLS), 5000)
+
+    rpc_recorder.request(
+        app, 'POST', '/api/backup/import', params={'filename': filenames})
+    rpc_recorder.assert_within_budget('POST /api/backup/import', {
+        'taskqueue.BulkAdd': 1,
+    }, 1000)
+
+    request_task(testbed, rpc_recorder, app)
+    # One put_multi per batch, plus one id reservation per book.
+    rpc_recorder.assert_within_budget(
+        'POST /api/backup/tasks/import', plus({
+            'datastore_v3.Put': 3,
+            'datastore_v3.AllocateIds': 1,
+            'memcache.Set': 3,
+            'memcache.Delete': 3,
+        }, GCS_READ_CALLS), 10000)
@@ -24,11 +24,14 @@ For more information, see README.md
 import os
 import urllib
 
+from google.appengine.api import datastore_errors
 from google.appengine.ext import ndb
 
 import webapp2
 import jinja2
 
+BOOKS_PER_PAGE = 20
+
 JINJA_ENVIRONMENT = jinja2.Environment(
     loader=jinja2.FileSystemLoader(os.path.dirname(__file__)),
     extensions=['jinja2.ext.autoescape'],
@@ -73,6 +76,17 @@ class Book(ndb.Model):
     def fetch_books(cls):
         return cls.query().order(cls.name)
 
+    @classmethod
+    def fetch_greeting_nums(cls, books):
+        """Returns the greeting count of each book by key.
+
+        The count queries of all books run in parallel.
+        """
+        futures = [Greeting.query(ancestor=book.key).count_async()
+                   for book in books]
+        return dict((book.key, future.get_result())
+                    for book, future in zip(books, futures))
+
     @classmethod
     def fetch_or_raise_book(cls, book_id):
         book = cls.get_by_id(long(book_id))
@@ -93,6 +107,13 @@ class Greeting(ndb.Model):
 class Tag(ndb.Model):
     name =  ndb.StringProperty(required=True)
 
+    @classmethod
+    def fetch_names(cls, tag_keys):
+        """Returns the names of the tags by key, read with one batch get."""
+        tag_keys = list(set(tag_keys))
+        return dict((tag.key, tag.name)
+                    for tag in ndb.get_multi(tag_keys) if tag is not None)
+
 
 class BookDataHandler:
     def fetch(self, guestbook_id):
@@ -108,10 +129,20 @@ class BookDataHandler:
 
 class MainPage(webapp2.RequestHandler):
     def get(self):
-        books = Book.fetch_books()
+        try:
+            cursor = ndb.Cursor(urlsafe=self.request.get('cursor'))
+        except datastore_errors.BadValueError:
+            self.abort(400, detail='cursor is not valid')
+        books, cursor, more = Book.fetch_books().fetch_page(
+            BOOKS_PER_PAGE, start_cursor=cursor)
+        tag_names = Tag.fetch_names(
+            tag_key for book in books for tag_key in book.tags)
 
         template_values = {
-            'books': books
+            'books': books,
+            'greeting_nums': Book.fetch_greeting_nums(books),
+            'tag_names': tag_names,
+            'next_cursor': cursor.urlsafe() if more else None
         }
 
         template = JINJA_ENVIRONMENT.get_template('index.html')
@@ -132,6 +163,7 @@ class BookPage(BookDataHandler, webapp2.RequestHandler):
                 'guestbook_id': guestbook_id,
                 'guestbook_name': urllib.quote_plus(guestbook_name),
                 'tag_keys': tag_keys,
+                'tag_names': Tag.fetch_names(tag_keys),
                 'greetings': greetings
             }
 
@@ -167,7 +199,6 @@ class BookHandler(BookDataHandler, webapp2.RequestHandler):
 
 class GreetingListHandler(BookDataHandler, webapp2.RequestHandler):
     def post(self, guestbook_id):
-        guestbook_id = 111
         book = BookDataHandler.fetch(self, guestbook_id)
         if book is None:
             pass
@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from google.appengine.ext import ndb
+import pytest
 import webtest
 
 import main
@@ -21,3 +23,148 @@ def test_app(testbed):
     app = webtest.TestApp(main.app)
     response = app.get('/')
     assert response.status_int == 200
+
+
+# More books than fit on one page of the book list.
+BOOK_COUNT = 30
+TAGS_PER_BOOK = 2
+GREETINGS_PER_BOOK = 25
+
+
+def seed():
+    """Stores BOOK_COUNT books, each with its own tags and greetings."""
+    tag_keys = ndb.put_multi(
+        [main.Tag(name='tag{}'.format(i))
+         for i in range(BOOK_COUNT * TAGS_PER_BOOK)])
+    book_keys = ndb.put_multi(
+        [main.Book(name='book{}'.format(i),
+                   tags=tag_keys[i * TAGS_PER_BOOK:(i + 1) * TAGS_PER_BOOK])
+         for i in range(BOOK_COUNT)])
+    ndb.put_multi(
+        [main.Greeting(parent=book_key, content='greeting{}'.format(i))
+         for book_key in book_keys for i in range(GREETINGS_PER_BOOK)])
+    return book_keys
+
+
+def get_rpcs(entity_group_count):
+    """ndb.get_multi sends at most 10 entity groups per Get RPC."""
+    return -(-entity_group_count // 10)
+
+
+def check_nothing(book_key):
+    pass
+
+
+def check_book_added(book_key):
+    assert main.Book.query().count() == BOOK_COUNT + 1
+
+
+def check_book_updated(book_key):
+    book = book_key.get()
+    assert book.name == 'renamed'
+    assert len(book.tags) == TAGS_PER_BOOK + 1
+
+
+def check_greeting_added(book_key):
+    assert book_key.get().fetch_greeting_num() == GREETINGS_PER_BOOK + 1
+
+
+def check_greeting_deleted(book_key):
+    assert book_key.get().fetch_greeting_num() == GREETINGS_PER_BOOK - 1
+
+
+# Budgets are per request with cold caches, against the data from seed().
+# The book list shows one page of books and counts the greetings of each
+# of them, so its query budget grows with BOOKS_PER_PAGE. The tags of the
+# page are read with one batch get, so any further per-book or per-tag
+# call fails.
+ROUTES = [
+    ('GET', '/', {}, 200, check_nothing, {
+        'datastore_v3.RunQuery': 1 + main.BOOKS_PER_PAGE,
+        'datastore_v3.Next': 1,
+        'datastore_v3.Get': get_rpcs(main.BOOKS_PER_PAGE * TAGS_PER_BOOK),
+        'memcache.Get': 2,
+        'memcache.Set': 2,
+    }, 2000),
+    ('GET', '/books/{book_id}', {}, 200, check_nothing, {
+        'datastore_v3.RunQuery': 1,
+        'datastore_v3.Get': 1 + get_rpcs(TAGS_PER_BOOK),
+        'memcache.Get': 4,
+        'memcache.Set': 4,
+    }, 1000),
+    ('POST', '/api/books', {'guestbook_name': 'new', 'tag_name': 'tag0'},
+     302, check_book_added, {
+        'datastore_v3.RunQuery': 1,
+        'datastore_v3.Put': 1,
+        'memcache.Delete': 1,
+    }, 1000),
+    ('POST', '/api/books/{book_id}',
+     {'guestbook_name': 'renamed', 'tag_name': 'new'},
+     302, check_book_updated, {
+        'datastore_v3.RunQuery': 1,
+        'datastore_v3.Get': 1,
+        'datastore_v3.Put': 2,
+        'memcache.Get': 2,
+        'memcache.Set': 3,
+        'memcache.Delete': 2,
+    }, 1000),
+    ('POST', '/api/books/{book_id}/greetings', {'content': 'hello'},
+     302, check_greeting_added, {
+        'datastore_v3.Get': 1,
+        'datastore_v3.Put': 1,
+        'memcache.Get': 2,
+        'memcache.Set': 2,
+        'memcache.Delete': 1,
+    }, 1000),
+    ('POST', '/api/books/{book_id}/greetings/{greeting_id}', {},
+     302, check_greeting_deleted, {
+        'datastore_v3.Get': 2,
+        'datastore_v3.Delete': 1,
+        'memcache.Get': 4,
+        'memcache.Set': 5,
+    }, 1000),
+]
+
+
+def request(rpc_recorder, method, url, params, status):
+    """Seeds the datastore and serves one recorded request."""
+    book_key = seed()[0]
+    greeting_key = main.Greeting.query(ancestor=book_key).get(keys_only=True)
+    url = url.format(book_id=book_key.id(), greeting_id=greeting_key.id())
+    app = webtest.TestApp(main.app)
+
+    response = rpc_recorder.request(app, method, url, params=params)
+    assert response.status_int == status
+    return book_key, '{} {}'.format(method, url)
+
+
+@pytest.mark.parametrize(
+    'method, url, params, status, check, calls, latency_ms', ROUTES)
+def test_rpc_budget(rpc_recorder, method, url, params, status, check, calls,
+                    latency_ms):
+    book_key, label = request(rpc_recorder, method, url, params, status)
+    check(book_key)
+    rpc_recorder.assert_within_budget(label, calls, latency_ms)
+
+
+@pytest.mark.parametrize(
+    'method, url, params, status, check, calls, latency_ms', ROUTES)
+def test_rpc_calls_do_not_grow(rpc_recorder, method, url, params, status,
+                               check, calls, latency_ms):
+    request(rpc_recorder, method, url, params, status)
+    calls = rpc_recorder.calls.copy()
+    # seed() again doubles the books, tags and greetings.
+    _, label = request(rpc_recorder, method, url, params, status)
+    rpc_recorder.assert_no_growth(label, calls)
+
+
+def test_book_list_pages(testbed):
+    seed()
+    app = webtest.TestApp(main.app)
+
+    response = app.get('/')
+    assert response.body.count('<li>') == main.BOOKS_PER_PAGE
+    response = response.click('Next')
+    assert response.body.count('<li>') == BOOK_COUNT - main.BOOKS_PER_PAGE
+    assert 'Next' not in response.body
+    app.get('/?cursor=garbage', status=400)